@@ -0,0 +1,32 @@
+from gpstrack import legacy_hash
+
+PLACES = ["Englischer Garten", "Isarinsel Oberföhring", "Wehranlage Oberföhring"]
+# TODO: what about Maximiliansanlagen/Heinrich-Mann-Allee/Thomas-Mann-Allee
+
+# don't put regex stuff in here
+
+HIGHWAY_BLACKLIST = frozenset(["service", "trunk", "trunk_link"])
+HIGHWAY_WHITELIST = [ht for ht in ['footway',
+ 'cycleway',
+ 'residential',
+ 'steps',
+ 'service',
+ 'unclassified',
+ 'track',
+ 'trunk_link',
+ 'trunk',
+ 'path',
+ 'bridleway'] if ht not in HIGHWAY_BLACKLIST]
+
+custom_filter = f'[highway~"^({"|".join(HIGHWAY_WHITELIST)})$"]'
+
+#network_type = "all"
+
+place_str = "@".join(PLACES + [custom_filter])
+
+# we use this file for caching the map data
+# (keeps the old hash so existing caches are still found)
+_place_hash = legacy_hash(place_str)
+GRAPHML_CACHE = f"data/{_place_hash}.graphml"
+# pickled copy of the graph, much faster to load than graphml
+GRAPH_PICKLE_CACHE = f"data/{_place_hash}.pkl"
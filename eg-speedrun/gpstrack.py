@@ -1,38 +1,90 @@
+import atexit
+import dbm
+import hashlib
 import json
 import os
-import re
+import shelve
+import threading
 import time
-from collections import OrderedDict
-from datetime import datetime
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime, timezone
+from itertools import groupby
 
+import numpy as np
+import orjson
 import osmnx as ox
+import pyproj
 import requests
+try:
+    from lxml.etree import iterparse
+except ImportError:
+    from xml.etree.ElementTree import iterparse
+import shapely
 from shapely.geometry import Point
 from networkx.exception import NodeNotFound
 
 
 def my_hash(text):
+    if isinstance(text, str):
+        text = text.encode()
+    return hashlib.blake2b(text, digest_size=8).hexdigest()
+
+
+def legacy_hash(text):
+    """Hash that was used for cache keys before my_hash switched to blake2b"""
     h=0
     [(h := ((h*281^ord(ch)*997)&0xffffffff)) for ch in text]
     return str(h)
 
 
-class GPSTrack:
-    trkpt_pattern = re.compile(r'<trkpt.*?</trkpt>', flags=re.DOTALL)
-    point_pattern = re.compile(r'<trkpt lat="([\d.-]+)" lon="([\d.-]+)">')
-    name_pattern = re.compile(r'<name>([^<]+)</name>')
-    date_pattern = re.compile(r'<time>([^<]+)</time>')
-    track_type_pattern = re.compile(r'<type>([^<]+)</type>')
+def parse_timestamp(text):
+    """Parse a gpx timestamp of the form 2021-05-01T10:00:00.000Z
+
+    Much faster than datetime.strptime as the format is fixed.
+    Other ISO 8601 timestamps are parsed with datetime.fromisoformat
+    and converted to naive UTC.
+    """
+    if len(text) in (20, 24) and text[-1] == "Z" and text[19] in ".Z":
+        return datetime(int(text[0:4]), int(text[5:7]), int(text[8:10]),
+                        int(text[11:13]), int(text[14:16]), int(text[17:19]))
+
+    date = datetime.fromisoformat(text)
+    if date.tzinfo is not None:
+        date = date.astimezone(timezone.utc).replace(tzinfo=None)
+    return date
+
 
+def strip_ns(tag):
+    """Remove the xml namespace from a tag name"""
+    return tag.rsplit("}", 1)[-1]
+
+
+VALHALLA_HEADERS = {'Content-type': 'application/json'}
+
+
+class GPSTrack:
     # TODO: also cache mapbox calls!!!!!!
     cache_path = None
     request_cache = None
+    # whether request_cache may still contain keys of legacy_hash
+    legacy_keys = False
+
+    # reuses connections to valhalla across tracks
+    session = requests.Session()
+
+    # mapbox rate limit, shared by all tracks that are matched concurrently
+    mapbox_lock = threading.Lock()
+    mapbox_next_start = 0.0
+
+    # derived data of graphs (projection, gdfs, ...), the graph is the same for all tracks
+    _graph_cache = {}
 
     def __init__(self, name, points, timestamps, track_type, date, filepath=None):
         """Create new GPSTrack
 
         :param name: the name of the gps track
-        :param points: list of (lat, long) floats
+        :param points: array of (lat, long) floats with shape (N, 2)
         :param timestamps: list of datetime objects corresponding to the points
         :param track_type: one of ["running"]
         :param date: datetime object representing the time of the run
@@ -46,58 +98,135 @@ class GPSTrack:
 
     @classmethod
     def from_gpx(cls, filepath):
-        with open(filepath) as f:
-            content = f.read()
-
-        name = cls.name_pattern.search(content).group(1)
-
-        m = cls.date_pattern.search(content)
-        if m is None:
+        name = None
+        datestr = None
+        track_type = None
+        coords = []
+        times = []
+
+        # stream through the file, trkpt elements are cleared after parsing
+        # so memory stays flat even for huge files
+        for _, elem in iterparse(filepath, events=("end",)):
+            tag = strip_ns(elem.tag)
+            if tag == "trkpt":
+                coords.append(elem.get("lat"))
+                coords.append(elem.get("lon"))
+                times.append(elem.find("{*}time").text.rstrip("Z"))
+                elem.clear()
+            elif tag == "time" and datestr is None:
+                datestr = elem.text
+            elif tag == "name" and name is None:
+                name = elem.text
+            elif tag == "type" and track_type is None:
+                track_type = elem.text
+
+        if datestr is None:
             date = None
         else:
-            datestr = m.group(1)
             try:
-                date = datetime.strptime(datestr, "%Y-%m-%dT%H:%M:%S.000Z")
+                date = parse_timestamp(datestr)
             except ValueError:
                 print(f"Failed to parse timestamp: {datestr}")
                 date = None
 
-        track_type = cls.track_type_pattern.search(content)
+        # convert all coordinates in one go instead of calling float() per value
+        points = np.array(coords, dtype=np.float64).reshape(-1, 2)
+        # same for the timestamps, numpy parses them and converts them back to datetime objects
+        timestamps = np.array(times, dtype="datetime64[ms]").tolist()
 
+        return cls(name=name, points=points, timestamps=timestamps, track_type=track_type, date=date, filepath=filepath)
 
-        track_points = cls.trkpt_pattern.findall(content)
 
-        points = [cls.point_pattern.search(text) for text in track_points]
-        if any(p is None for p in points):
-            print(filepath)
-            breakpoint()
-        points = [point.groups() for point in points]
-        points = [tuple(float(p) for p in point) for point in points]
+    @classmethod
+    def from_gpx_batch(cls, filepaths, workers=None):
+        """Parse multiple gpx files in parallel
 
-        timestamps = [datetime.strptime(cls.date_pattern.search(text).group(1), "%Y-%m-%dT%H:%M:%S.000Z")
-                      for text in track_points]
-        return cls(name=name, points=points, timestamps=timestamps, track_type=track_type, date=date, filepath=filepath)
+        :param filepaths: list of paths to gpx files
+        :param workers: number of worker processes, defaults to the number of cpus
+        :returns: iterator over the parsed GPSTracks, in the order of filepaths
+        """
+        with ProcessPoolExecutor(workers) as ex:
+            yield from ex.map(cls.from_gpx, filepaths, chunksize=8)
 
 
     @classmethod
     def set_cachefile(cls, filepath):
         cls.cache_path = filepath
 
-        if os.path.isfile(filepath):
+        dir = os.path.dirname(filepath)
+        if dir and not os.path.isdir(dir):
+            os.makedirs(dir)
+
+        # older versions stored the cache as a single json file
+        legacy_cache = None
+        if dbm.whichdb(filepath) == "":
             with open(filepath, "r") as f:
-                cls.request_cache = json.load(f)
-                # print(cls.request_cache.keys())
+                legacy_cache = json.load(f)
+            os.rename(filepath, filepath + ".json.bak")
+
+        # every insert is persisted on its own, no need to rewrite the whole cache
+        cls.request_cache = shelve.open(filepath)
+        # close explicitly, also if main fails later on
+        atexit.register(cls.request_cache.close)
+        if legacy_cache is not None:
+            cls.request_cache.update(legacy_cache)
+
+        # legacy keys are decimal numbers, my_hash keys are longer hex strings
+        cls.legacy_keys = any(k.isdigit() and len(k) <= 10 for k in cls.request_cache)
 
     @classmethod
-    def flush_cachefile(cls):
-        if cls.cache_path is not None and cls.request_cache is not None:
-            dir = os.path.dirname(cls.cache_path)
-            if not os.path.isdir(dir):
-                os.makedirs(dir)
+    def graph_cached(cls, G, name, func):
+        """Compute func(G) only once per graph
+
+        Note that G must not be modified after it was used for matching.
+
+        :param G: osmnx Graph
+        :param name: name of the derived data
+        :param func: function computing the data from G
+        :returns: func(G)
+        """
+        key = (id(G), name)
+        # keep a reference to G, otherwise its id could be reused
+        if key not in cls._graph_cache or cls._graph_cache[key][0] is not G:
+            cls._graph_cache[key] = (G, func(G))
+        return cls._graph_cache[key][1]
+
+    @staticmethod
+    def edges_gdf(G):
+        """Edges of G as GeoDataFrame, the nodes one is not needed for matching"""
+        return ox.graph_to_gdfs(G, nodes=False)
+
+    @staticmethod
+    def graph_hash(G):
+        """Hash of the edges of G, identifies the graph in cache keys"""
+        return my_hash(str(sorted(G.edges(keys=True))))
+
+    @staticmethod
+    def edge_data_index(G):
+        """Map (u, v) to the data of an edge between them"""
+        return {(u,v): data for (u,v,data) in G.edges(data=True)}
 
-            with open(cls.cache_path, "w") as f:
-                tmp = json.dumps(cls.request_cache)
-                f.write(tmp)
+    @staticmethod
+    def way_edge_index(G):
+        """Map osm way ids to the edges of G belonging to that way"""
+        gdf_edges = GPSTrack.graph_cached(G, "gdf_edges", GPSTrack.edges_gdf)
+        way_edges = defaultdict(list)
+        for (idx,osmid) in zip(gdf_edges.index, gdf_edges["osmid"]):
+            if type(osmid) == list:
+                for o in osmid:
+                    way_edges[o].append(idx)
+            else:
+                way_edges[osmid].append(idx)
+        return way_edges
+
+    @staticmethod
+    def edge_rtree(G):
+        """Build a spatial index over the edges of G, as used by ox.nearest_edges
+
+        :returns: edge index and shapely STRtree of the edge geometries
+        """
+        geoms = ox.graph_to_gdfs(G, nodes=False)["geometry"]
+        return geoms.index, shapely.STRtree(geoms)
 
     def __str__(self):
         return f"""
@@ -108,16 +237,79 @@ GPSTrack(name={self.name}, date={self.date}, type={self.track_type}, points={len
 
 
 
-    def match_graph(self, G, valhalla_url=None):
-        """match route against edges in G using valhalla APIII
+    def match_key(self, G, valhalla_url=None):
+        """Cache key of the match_graph result for this gpx file, graph and api"""
+        graph_hash = GPSTrack.graph_cached(G, "hash", GPSTrack.graph_hash)
+        baseurl = GPSTrack.valhalla_baseurl(valhalla_url)
+        use_mapbox = os.getenv("MAPBOX_ACCESS_TOKEN") != None
+        return "match-" + my_hash(f"{self.filepath}:{os.path.getmtime(self.filepath)}:{graph_hash}:{baseurl}:{use_mapbox}")
+
+    def match_graph_cached(self, G, valhalla_url=None):
+        """match_graph, but the result is cached per gpx file and graph
 
         :param G: graph to match against
-        :returns: list of matched edges contained in G
+        :returns: matched edges and filler edges as returned by match_graph
         """
-        from shapely.geometry import Point
+        if GPSTrack.request_cache is None:
+            GPSTrack.request_cache = {}
 
-        # Query API
+        key = self.match_key(G, valhalla_url)
+        if key not in GPSTrack.request_cache:
+            route,fillers = self.match_graph(G, valhalla_url)
+            if route is None:
+                return None,None
+            GPSTrack.request_cache[key] = (route, fillers, self.matched_points)
+
+        route,fillers,self.matched_points = GPSTrack.request_cache[key]
+        return list(route),list(fillers)
+
+    @classmethod
+    def match_graph_batch(cls, tracks, G, valhalla_url=None, workers=8):
+        """match_graph_cached for multiple tracks, with concurrent valhalla requests
+
+        Only the http requests run in worker threads, the cache is used from
+        the calling thread only (a shelve must not be shared between threads).
 
+        :param tracks: list of GPSTracks
+        :param G: graph to match against
+        :param workers: maximum number of concurrent requests
+        :returns: iterator over (route, fillers) tuples, in the order of tracks
+        """
+        if cls.request_cache is None:
+            cls.request_cache = {}
+
+        with ThreadPoolExecutor(workers) as ex:
+            # look up the cache and send the requests that are missing
+            jobs = []
+            for track in tracks:
+                key = track.match_key(G, valhalla_url)
+                if key in cls.request_cache:
+                    jobs.append((track, key, None, None))
+                    continue
+                url, body, request_hash, d = track.valhalla_request(valhalla_url)
+                text = cls.cached_response(request_hash, d)
+                if text is None:
+                    print("Sending request to Valhalla for map matching")
+                    text = ex.submit(cls.session.post, url, data=body, headers=VALHALLA_HEADERS)
+                jobs.append((track, key, request_hash, text))
+
+            # store responses and matches in the order of tracks
+            for (track, key, request_hash, text) in jobs:
+                if request_hash is not None:
+                    if not isinstance(text, str):
+                        text = track.store_response(request_hash, text.result())
+                        if text is None:
+                            yield None,None
+                            continue
+                    route,fillers = track.match_response(G, text)
+                    cls.request_cache[key] = (route, fillers, track.matched_points)
+
+                route,fillers,track.matched_points = cls.request_cache[key]
+                yield list(route),list(fillers)
+
+    @staticmethod
+    def valhalla_baseurl(valhalla_url=None):
+        """Base url of the valhalla api, falls back to VALHALLA_URL env. var"""
         if valhalla_url is not None:
             baseurl = valhalla_url
         else:
@@ -125,21 +317,27 @@ GPSTrack(name={self.name}, date={self.date}, type={self.track_type}, points={len
 
         if not baseurl.startswith("http"):
             baseurl = "https://" + baseurl
+        return baseurl
+
+    def valhalla_request(self, valhalla_url=None):
+        """Build the valhalla trace_attributes request for this track
 
-        url = f"{baseurl}/trace_attributes"
+        :returns: url, json encoded body, cache key and the request as dict
+        """
+        url = f"{GPSTrack.valhalla_baseurl(valhalla_url)}/trace_attributes"
         # shape = [{"lat": p[0], "lon": p[1], "type": "via"} for p in self.points]
         # shape[0]["type"] = "break"
         # shape[-1]["type"] = "break"
         if os.getenv("MAPBOX_ACCESS_TOKEN") != None:
             points = GPSTrack.fit_points_mapbox(self.points, self.timestamps)
         else:
-            points = self.points
-        # shape = [OrderedDict({"lat": p[0], "lon": p[1],
-        #                       "time": (self.timestamps[i] - self.timestamps[0]).total_seconds()})
+            points = self.points.tolist()
+        # shape = [{"lat": p[0], "lon": p[1],
+        #           "time": (self.timestamps[i] - self.timestamps[0]).total_seconds()}
         #          for (i,p) in enumerate(points)]
-        shape = [OrderedDict({"lat": p[0], "lon": p[1]}) for p in points]
+        shape = [{"lat": p[0], "lon": p[1]} for p in points]
 
-        d = OrderedDict()
+        d = {}
         d["shape"] = shape
         # auto matches almost nothing
         d["costing"] = "pedestrian"
@@ -148,28 +346,65 @@ GPSTrack(name={self.name}, date={self.date}, type={self.track_type}, points={len
         # d["begin_time"] = self.timestamps[0].strftime("%Y-%m-%dT%H:%M:%S.000Z")
         # d["durations"] = [(d-d_prev).total_seconds() for (d_prev,d) in zip(self.timestamps[:-1], self.timestamps[1:])]
 
-        headers = {'Content-type': 'application/json'}
+        # serialize once, used as cache key and request body
+        body = orjson.dumps(d)
+        request_hash = my_hash(url.encode() + body)
+        return url, body, request_hash, d
+
+    @staticmethod
+    def cached_response(request_hash, d):
+        """Cached valhalla response text for a request, or None"""
+        if GPSTrack.legacy_keys and request_hash not in GPSTrack.request_cache:
+            # migrate entries cached with the old hash function and json encoding
+            old_hash = legacy_hash(json.dumps(d))
+            if old_hash in GPSTrack.request_cache:
+                GPSTrack.request_cache[request_hash] = GPSTrack.request_cache.pop(old_hash)
+        return GPSTrack.request_cache.get(request_hash)
+
+    def store_response(self, request_hash, r):
+        """Cache a valhalla response
+
+        :returns: response text, None if the request failed
+        """
+        if r.status_code != 200:
+            print(self.name)
+            print("Unexpected valhalla http return value")
+            print(r.text)
+            return None
 
+        GPSTrack.request_cache[request_hash] = r.text
+        return r.text
 
+    def match_graph(self, G, valhalla_url=None):
+        """match route against edges in G using valhalla APIII
+
+        :param G: graph to match against
+        :returns: list of matched edges contained in G
+        """
         if GPSTrack.request_cache is None:
             GPSTrack.request_cache = {}
 
-        request_hash = my_hash(json.dumps(d))
-        if request_hash not in GPSTrack.request_cache:
+        # Query API
+
+        url, body, request_hash, d = self.valhalla_request(valhalla_url)
+        text = GPSTrack.cached_response(request_hash, d)
+        if text is None:
             print("Sending request to Valhalla for map matching")
-            r = requests.post(url, data=json.dumps(d), headers=headers)
-            if r.status_code != 200:
-                print(self.name)
-                print("Unexpected valhalla http return value")
-                print(r.text)
-                return None
+            r = GPSTrack.session.post(url, data=body, headers=VALHALLA_HEADERS)
+            text = self.store_response(request_hash, r)
+            if text is None:
+                return None,None
 
-            GPSTrack.request_cache[request_hash] = r.text
-            GPSTrack.flush_cachefile()
+        return self.match_response(G, text)
 
-        text = GPSTrack.request_cache[request_hash]
+    def match_response(self, G, text):
+        """Match the edges of a valhalla trace_attributes response against G
 
-        res = json.loads(text)
+        :param G: graph to match against
+        :param text: valhalla response
+        :returns: list of matched edges contained in G and filler edges
+        """
+        res = orjson.loads(text)
 
         # parse result
         matched_points = [p for p in res["matched_points"] if p["type"] == "matched"]
@@ -177,42 +412,47 @@ GPSTrack(name={self.name}, date={self.date}, type={self.track_type}, points={len
         # save for optional later use
         self.matched_points = [(p['lat'],p['lon']) for p in matched_points]
 
-        gdf_edges = ox.graph_to_gdfs(G, nodes=False)
+        gdf_edges = GPSTrack.graph_cached(G, "gdf_edges", GPSTrack.edges_gdf)
+        way_edges = GPSTrack.graph_cached(G, "way_edges", GPSTrack.way_edge_index)
 
         edges = res["edges"]
         matched_edges = []
         matchcount = 0
-        for matched_point in matched_points:
+
+        def way_of(matched_point):
             edge_index = matched_point["edge_index"]
             if edge_index >= len(edges):
                 print("Warning: Encountered edge index higher than number of edges?!!")
-                continue
-            matched_edge = edges[edge_index]
-            way_id = matched_edge["way_id"]
-
-
+                return None
+            return edges[edge_index]["way_id"]
 
-            mask = gdf_edges["osmid"].apply(lambda x: (type(x) == int and way_id == x)
-                                                      or (type(x) == list and way_id in x))
+        # consecutive points usually lie on the same way, look up its edges only once
+        for (way_id,group) in groupby(matched_points, key=way_of):
+            if way_id is None:
+                continue
 
-            filtered = gdf_edges[mask]
+            filtered = gdf_edges.loc[way_edges.get(way_id, [])]
             if len(filtered) == 0:
                 continue
 
-            # one osm "way" contains multiple edges from our graph (if it wasn't simplified)
-            # we look which one is closest to the point
-            p = Point(matched_point['lon'], matched_point['lat'])
-            # TODO: is some projection needed or does "coordinate distance" preserve order?
-            with_distance = filtered.assign(distance=filtered.apply(lambda row: row.geometry.distance(p), axis=1))
-
-            # edges in both ways will be containe
-            sorted = with_distance.sort_values("distance")
-            # u->v and v->u could be saved in graph G
-            if sorted.iloc[1]["distance"] == sorted.iloc[0]["distance"]:
-                matched_edges += list(sorted[:2].index)
-            else:
-                matched_edges += list(sorted[:1].index)
-            matchcount += 1
+            for matched_point in group:
+                # one osm "way" contains multiple edges from our graph (if it wasn't simplified)
+                # we look which one is closest to the point
+                p = Point(matched_point['lon'], matched_point['lat'])
+                # TODO: is some projection needed or does "coordinate distance" preserve order?
+                distances = filtered.geometry.distance(p).values
+
+                # edges in both ways will be contained, we only need the two closest ones
+                if len(distances) > 1:
+                    closest = np.argpartition(distances, 1)[:2]
+                else:
+                    closest = np.array([0])
+                # u->v and v->u could be saved in graph G
+                if len(closest) > 1 and distances[closest[1]] == distances[closest[0]]:
+                    matched_edges += list(filtered.index[closest])
+                else:
+                    matched_edges += list(filtered.index[closest[:1]])
+                matchcount += 1
 
         print(f"Matched {matchcount/len(matched_points) * 100}% of valhalla points with graph")
 
@@ -251,9 +491,7 @@ GPSTrack(name={self.name}, date={self.date}, type={self.track_type}, points={len
                 matched_graph_edges_uni.append((u,v))
 
         # helpers
-        edge_dict = {}
-        for edge in G.edges(data=True):
-            edge_dict[(edge[0],edge[1])] = edge[2]
+        edge_dict = GPSTrack.graph_cached(G, "edge_dict", GPSTrack.edge_data_index)
 
         def path_length(path):
             return sum(edge_dict[(u,v)]['length'] for (u,v) in zip(path[:-1],path[1:]))
@@ -312,11 +550,10 @@ GPSTrack(name={self.name}, date={self.date}, type={self.track_type}, points={len
 
         # finally, add filler edges to matched edges
         filler_graph_edges = []
-        gdf_edges = ox.graph_to_gdfs(G, nodes=False)
         for (u,v) in filler_edges:
-            if (u,v,0) in gdf_edges.index:
+            if G.has_edge(u,v,0):
                 filler_graph_edges.append((u,v,0))
-            if (v,u,0) in gdf_edges.index:
+            if G.has_edge(v,u,0):
                 filler_graph_edges.append((v,u,0))
 
         return filler_graph_edges
@@ -325,7 +562,7 @@ GPSTrack(name={self.name}, date={self.date}, type={self.track_type}, points={len
 
 
     @staticmethod
-    def fit_points_mapbox(points, timestamps):
+    def fit_points_mapbox(points, timestamps, max_workers=5, requests_per_minute=60):
         # https://mapbox-mapbox.readthedocs-hosted.com/en/latest/mapmatching.html
         from mapbox import MapMatcher
         mm = MapMatcher()
@@ -333,14 +570,19 @@ GPSTrack(name={self.name}, date={self.date}, type={self.track_type}, points={len
 
         # API only allows 100 points
         print(f"Matching {len(points)} points with matchbox")
-        history = []
+        chunks = []
         for i in range(0, len(points), 100):
             if (len(points) - i) < 2:
                 # mapbox needs at least 2 coordinates
                 # in rare cases when points % 100 = 1
                 # we loose one point
                 continue
-            j = min(i + 100, len(points))
+            chunks.append((i, min(i + 100, len(points))))
+
+        # requests run in parallel, but their starts are spaced out
+        # to stay below the rate limit of the API
+        def match_chunk(chunk):
+            i,j = chunk
             line = {
                 "type": "Feature",
                 "properties": {
@@ -352,6 +594,12 @@ GPSTrack(name={self.name}, date={self.date}, type={self.track_type}, points={len
                 }
             }
 
+            with GPSTrack.mapbox_lock:
+                now = time.monotonic()
+                start = max(now, GPSTrack.mapbox_next_start)
+                GPSTrack.mapbox_next_start = start + 60 / requests_per_minute
+            time.sleep(start - now)
+
             # for some reason, mapbox excludes "highway:cycling" edges when using walking profile
             # TODO: find good gps_precision parameter
             r = mm.match(line, profile="mapbox.cycling")
@@ -363,10 +611,11 @@ GPSTrack(name={self.name}, date={self.date}, type={self.track_type}, points={len
 
             corrected = r.geojson()['features'][0]['geometry']['coordinates']
             print(f"{i}:{j} ({j-i} points) -> corrected to {len(corrected)} points")
-            history += corrected
-
+            return corrected
 
-            time.sleep(1)
+        # map keeps the order of the chunks
+        with ThreadPoolExecutor(max_workers) as ex:
+            history = [c for corrected in ex.map(match_chunk, chunks) for c in corrected]
 
 
         return [(c[1],c[0]) for c in history]
@@ -383,69 +632,57 @@ GPSTrack(name={self.name}, date={self.date}, type={self.track_type}, points={len
         """
 
         # project graph and points
-        P = ox.project_graph(G)
-        points_p = []
-        for plat,plon in self.points:
-            point_p, _ = ox.projection.project_geometry(Point(plon,plat), to_crs=P.graph['crs'])
-            points_p.append(point_p)
+        P = GPSTrack.graph_cached(G, "projected", ox.project_graph)
+        transformer = GPSTrack.graph_cached(G, "transformer", lambda G:
+            pyproj.Transformer.from_crs(G.graph['crs'], P.graph['crs'], always_xy=True))
+        # points recorded while standing still are identical, query them only once
+        uniq, inv = np.unique(self.points, axis=0, return_inverse=True)
+        inv = inv.reshape(-1)
+        xs, ys = transformer.transform(uniq[:,1], uniq[:,0])
 
 
         # find neared edge for each point
-        es = ox.nearest_edges(P, [p.x for p in points_p], [p.y for p in points_p], return_dist=True)
-        #return es[0]
+        edge_index, rtree = GPSTrack.graph_cached(P, "edge_rtree", GPSTrack.edge_rtree)
+        (_, pos), dist = rtree.query_nearest(shapely.points(xs, ys), all_matches=False, return_distance=True)
+        pos, dist = pos[inv], dist[inv]
 
 
-        # make list of (edge, distance, point)
-        es = [(e,es[1][i],self.points[i]) for (i,e) in enumerate(es[0])]
-
-        gdf_nodes, gdf_edges = ox.graph_to_gdfs(G)
-
         # remove edges too far away from measurement
-        es2 = []
-        for i,e in enumerate(es):
-            dist = e[1]
-            if dist < max_distance:
-                es2.append(e)
-
-        es3 = []
-
+        near = dist < max_distance
+        edges = list(edge_index[pos[near]])
+        points = self.points[near]
+        if len(edges) == 0:
+            return []
 
         # A very hacky heuristic
-        prev_e = None
-        edge_streak = []
-        from collections import defaultdict
-        d = defaultdict(list)
         MIN_STREAK = 3
-        for i,e in enumerate(es2 + [((-1,-1,-1),-1,(-1,-1))]):
-            if prev_e != None:
-                if prev_e[0] != e[0]:
-                    # if we measured MIN_STREAK or more points on the edge after each other
-                    # we confirm the edge
-                    if len(edge_streak) >= MIN_STREAK:
-                        es3 += edge_streak
-                    else:
-                        # to avoid path where we where only shortly close to them
-                        # but not really on the path, we check whether our measurements
-                        # where too "close" to an intersection
-                        l = []
-                        for check_e in edge_streak:
-                            length = gdf_edges.loc[check_e[0]]["length"]
-                            p = check_e[2]
-                            p0 = check_e[0][0]
-                            p1 = check_e[0][1]
-                            d0 = ox.distance.great_circle_vec(gdf_nodes.loc[p0]["y"],gdf_nodes.loc[p0]["x"],p[0],p[1])
-                            d1 = ox.distance.great_circle_vec(gdf_nodes.loc[p1]["y"],gdf_nodes.loc[p1]["x"],p[0],p[1])
-                            dist = min(d0,d1)
-                            l.append(dist/length)
-                            #d[e[0]].append(dist/length)
-                        if max(l) > 0.2:
-                            es3 += edge_streak
-
-                    edge_streak = []
-
-            edge_streak.append(e)
-            prev_e = e
-
-
-        route = [e[0] for e in es3]
+
+        # split points into streaks of consecutive points on the same edge
+        edge_arr = np.array(edges, dtype=np.int64).reshape(-1, 3)
+        changes = np.flatnonzero((edge_arr[1:] != edge_arr[:-1]).any(axis=1)) + 1
+        starts = np.concatenate([[0], changes])
+        streak_len = np.diff(np.concatenate([starts, [len(edges)]]))
+        streak_of_point = np.repeat(np.arange(len(starts)), streak_len)
+
+        # if we measured MIN_STREAK or more points on the edge after each other
+        # we confirm the edge.
+        # to avoid path where we where only shortly close to them
+        # but not really on the path, we check whether the measurements
+        # of shorter streaks where too "close" to an intersection
+        check = streak_len[streak_of_point] < MIN_STREAK
+        ratio = np.zeros(len(edges))
+        if check.any():
+            # only few edges need checking, look them up in G directly
+            checked = edge_arr[check].tolist()
+            u_yx = np.array([(G.nodes[u]["y"], G.nodes[u]["x"]) for (u,_,_) in checked])
+            v_yx = np.array([(G.nodes[v]["y"], G.nodes[v]["x"]) for (_,v,_) in checked])
+            lengths = np.array([G.edges[u,v,k]["length"] for (u,v,k) in checked])
+            ps = points[check]
+            d0 = ox.distance.great_circle_vec(u_yx[:,0], u_yx[:,1], ps[:,0], ps[:,1])
+            d1 = ox.distance.great_circle_vec(v_yx[:,0], v_yx[:,1], ps[:,0], ps[:,1])
+            ratio[check] = np.minimum(d0,d1) / lengths
+
+        keep_streak = (streak_len >= MIN_STREAK) | (np.maximum.reduceat(ratio, starts) > 0.2)
+
+        route = [edges[i] for i in np.flatnonzero(keep_streak[streak_of_point])]
         return route
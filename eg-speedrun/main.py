@@ -3,49 +3,27 @@ import argparse
 import json
 import os
 import os.path
+import pickle
 import sys
 import time
+from collections import Counter
 from datetime import datetime
+from itertools import chain
 from pprint import pprint
 
 import folium
 import folium.plugins
 import matplotlib.pyplot as plt
 import osmnx as ox
+import pandas as pd
 from tqdm import tqdm
 
+from config import *
 from plot import *
-from gpstrack import GPSTrack,my_hash
+from gpstrack import GPSTrack
 from bad_edges import BAD_EDGE_LIST
 
 DEFAULT_PLOTS_DIR = "plots"
-PLACES = ["Englischer Garten", "Isarinsel Oberföhring", "Wehranlage Oberföhring"]
-# TODO: what about Maximiliansanlagen/Heinrich-Mann-Allee/Thomas-Mann-Allee
-
-# don't put regex stuff in here
-
-HIGHWAY_BLACKLIST = ["service", "trunk", "trunk_link"]
-HIGHWAY_WHITELIST = [ht for ht in ['footway',
- 'cycleway',
- 'residential',
- 'steps',
- 'service',
- 'unclassified',
- 'track',
- 'trunk_link',
- 'trunk',
- 'path',
- 'bridleway'] if ht not in HIGHWAY_BLACKLIST]
-
-custom_filter = f'[highway~"^({"|".join(list(HIGHWAY_WHITELIST))})$"]'
-
-#network_type = "all"
-
-place_str = "@".join(PLACES + [custom_filter])
-
-# we use this file for caching the map data
-GRAPHML_CACHE = f"data/{my_hash(place_str)}.graphml"
-
 TO_RUN_COLOR = "#d0d0d0"
 #BGCOLOR = "#33333300"
 BGCOLOR = "#00000000"
@@ -67,12 +45,15 @@ Plot graphs in English Garden of past tracks.
 """.strip())
 
     parser.add_argument("--valhalla", default=None, required=False, help="URL to basis of valhalla api endpoint, can also be defined by setting VALHALLA_URL env. var")
+    parser.add_argument("--valhalla-workers", default=8, type=int, help="Maximum number of concurrent requests to valhalla (default: 8), lower it for public instances with rate limits")
     parser.add_argument("--gpxdir", "-d", required=True, help="The directory containing the gpx files for your runs.")
     parser.add_argument("--filter-date", default=0, type=int, help="Optional UNIX timestamp. Consider only gps tracks recorded later or equal of that timestamp")
     parser.add_argument("--filter-name", default=None, help="Consider only gpx files with that name.")
     parser.add_argument("--outdir", "-o", default=DEFAULT_PLOTS_DIR, help="The directory where the plots are produced in.")
     parser.add_argument("--cachefile", "-c", default=None, help="Path to a file where map matching results are cached. File will be created if it does not exist yet")
     parser.add_argument("--no-fill-gaps", default=False, action="store_true", help="Whether to disable automatic filling of gaps during map matching")
+    parser.add_argument("--png-dpi", default=300, type=int, help="Resolution of the static png map, memory usage grows quadratically with it")
+    parser.add_argument("--no-static-plot", default=False, action="store_true", help="Skip the static pdf/png map, e.g. when only the html map or statistics are needed")
     parser.add_argument("--debug", default=False, action="store_true", help="Generate some useful debug plots")
     parser.add_argument("--fix", required=False, help="Path to a fix.json file (dict of filenames (without parent directories) to list of edges)")
 
@@ -80,7 +61,7 @@ Plot graphs in English Garden of past tracks.
 
 def setup(args):
     # caching is done by this program itself
-    ox.config(use_cache=False)
+    ox.settings.use_cache = False
 
     if args.valhalla is None and "VALHALLA_URL" not in os.environ:
         print("--valhalla flag or VALLHALLA_URL environment variable have to be set")
@@ -92,18 +73,31 @@ def setup(args):
         G = ox.graph_from_place(PLACES, custom_filter=custom_filter, retain_all=True,
                                 truncate_by_edge=False, simplify=False)
         ox.save_graphml(G, filepath=GRAPHML_CACHE)
+        with open(GRAPH_PICKLE_CACHE, "wb") as f:
+            pickle.dump(G, f, protocol=5)
+    elif os.path.isfile(GRAPH_PICKLE_CACHE):
+        with open(GRAPH_PICKLE_CACHE, "rb") as f:
+            G = pickle.load(f)
+    else:
+        G = ox.load_graphml(filepath=GRAPHML_CACHE)
+        # graphml caches from older versions get a pickle on first load
+        with open(GRAPH_PICKLE_CACHE, "wb") as f:
+            pickle.dump(G, f, protocol=5)
 
     # setup cachefile for valhalla requests
     if args.cachefile is not None:
         GPSTrack.set_cachefile(args.cachefile)
 
+    return G
+
 
 def load_relevant_tracks(gpxdir, filter_date, filter_name=None):
-    gpxfiles = [os.path.join(gpxdir, f) for f in os.listdir(gpxdir) if f.endswith(".gpx")]
+    with os.scandir(gpxdir) as it:
+        gpxfiles = [e.path for e in it if e.name.endswith(".gpx") and e.is_file()]
 
     print(f"Found {len(gpxfiles)} gpxfiles")
     print(f"Parsing gpx files...")
-    tracks_tocheck = [GPSTrack.from_gpx(f) for f in tqdm(gpxfiles)]
+    tracks_tocheck = list(tqdm(GPSTrack.from_gpx_batch(gpxfiles), total=len(gpxfiles)))
     print(f"Parsing done.")
 
 
@@ -140,7 +134,7 @@ def main():
     parser = create_parser()
     args = parser.parse_args()
 
-    setup(args)
+    G = setup(args)
 
     outdir = f"{args.outdir}/{int(time.time())}"
     #outdir = f"{args.outdir}"
@@ -153,18 +147,18 @@ def main():
                                   datetime.fromtimestamp(args.filter_date),
                                   args.filter_name)
 
-    # load our graph
-    G = ox.load_graphml(filepath=GRAPHML_CACHE)
+    # save whole graph as interactive html for debugging
+    # (before removing the bad edges, so they can be picked out on it)
+    if args.debug:
+        print("Generating debug maps...")
+        plot_html_debug(G, f"{outdir}/english_garden_infos.html")
+        print(f"Edge info html map done: {outdir}/english_garden_infos.html")
 
     # remove bad edges
     G.remove_edges_from(set((u,v,0) for (u,v) in BAD_EDGE_LIST)
                         | set((v,u,0) for (u,v) in BAD_EDGE_LIST))
 
-    # save whole graph as interactive html for debugging
     if args.debug:
-        print("Generating debug maps...")
-        plot_html_debug(G, f"{outdir}/english_garden_infos.html", GRAPHML_CACHE)
-        print(f"Edge info html map done: {outdir}/english_garden_infos.html")
         plot_html_by_highway(G, f"{outdir}/english_garden_highway.html")
         print(f"Highway type html map done: {outdir}/english_garden_highway.html")
 
@@ -173,9 +167,8 @@ def main():
     # match tracks with edges
     print("Matching gps points to edges...")
     matched_tracks = []
-    for track in tqdm(tracks):
-        route,fillers = track.match_graph(G, args.valhalla)
-
+    results = GPSTrack.match_graph_batch(tracks, G, args.valhalla, workers=args.valhalla_workers)
+    for (track,(route,fillers)) in zip(tracks, tqdm(results, total=len(tracks))):
 
         if route is None:
             print(f"Track {track.filepath} - '{track.name}' map matching failed")
@@ -202,7 +195,7 @@ def main():
                 edges_to_remove = [a for f in fixes[fname] for a in f.get("remove", [])]
                 to_add = list(set((u,v,0) for (u,v) in edges_to_add)
                         | set((v,u,0) for (u,v) in edges_to_add))
-                to_remove = list(set((u,v,0) for (u,v) in edges_to_remove)
+                to_remove = (set((u,v,0) for (u,v) in edges_to_remove)
                         | set((v,u,0) for (u,v) in edges_to_remove))
                 route = [r for r in route if r not in to_remove]
                 route += to_add
@@ -213,9 +206,6 @@ def main():
 
 
 
-    runned_edges = set(a for t in matched_tracks for a in t[1])
-    to_run_edges = G.edges(keys=True) - runned_edges
-
     # make undirected
     G_uni = G.copy()
     G_edges = G.edges(keys=True)
@@ -229,58 +219,59 @@ def main():
 
     G = G_uni
 
-    # edges will keep track of the color for each edge for static plot
+    # map routes onto the edges of the undirected graph
+    G_edges = G.edges(keys=True)
+    matched_tracks = [(track, [(u,v,k) if (u,v,k) in G_edges else (v,u,k)
+                               for (u,v,k) in route
+                               if (u,v,k) in G_edges or (v,u,k) in G_edges])
+                      for (track,route) in matched_tracks]
+
+    # edges will keep track of the color for each edge for static plot,
+    # all other edge data is taken from it as well
     edges_color = ox.graph_to_gdfs(G, nodes=False)
     # default: to run -> gray
     edges_color["color"] = TO_RUN_COLOR
 
-    G_to_run = G.copy()
-    G_to_run.remove_edges_from(runned_edges)
-
-    G_runned = G.copy()
-    G_runned.remove_edges_from(to_run_edges)
+    all_edges = frozenset(G_edges)
+    runned_edges = frozenset(chain.from_iterable(route for (_,route) in matched_tracks))
+    to_run_edges = all_edges - runned_edges
 
 
     # m will be the folium.Map object for html visualization
     # plot to-run edges in gray
     print("Generating interactive html map of tracks...")
-    m = ox.plot_graph_folium(G_to_run,
-                             tiles="CartoDB positron",
-                             fit_bounds=True,
-                             weight=3,
-                             color=TO_RUN_COLOR,
-                             opacity=1.0)
+    gdf_to_run = edges_color.loc[list(to_run_edges)]
+    m = folium.Map(tiles="CartoDB positron")
+    add_edges_polylines(m, gdf_to_run, color=TO_RUN_COLOR, weight=3, opacity=1.0)
+    tb = gdf_to_run.total_bounds
+    m.fit_bounds([(tb[1], tb[0]), (tb[3], tb[2])])
 
 
     colors = plt.rcParams['axes.prop_cycle'].by_key()['color']
 
+    tracks_edges = []
     for (i,t) in enumerate(tqdm(matched_tracks)):
         track,route = t
 
         # determine next color
         next_color = colors[i % len(colors)]
 
-        # get graph with only the runned edges
-        to_remove = set(e for e in G.edges(keys=True) if e not in route)
-        G_track = G.copy()
-        G_track.remove_edges_from(to_remove)
+        # get only the runned edges
+        route_list = list(set(route))
 
         # color edges in our color lookup
-        edges_ran = G_track.edges(keys=True)
-        edges_color.loc[edges_color.index.isin(edges_ran),"color"] = next_color
+        edges_color.loc[route_list,"color"] = next_color
 
         # add route info for interactive html popup
-        gdf_nodes, gdf_edges = ox.graph_to_gdfs(G_track)
+        gdf_edges = edges_color.loc[route_list].copy()
         gdf_edges['route_info'] = f"{track.date.strftime('%Y-%m-%d')}"
-        gdf_edges['match_count'] = [route.count(key) for key in gdf_edges.index]
+        match_count = Counter(route)
+        gdf_edges['match_count'] = [match_count[key] for key in gdf_edges.index]
+        tracks_edges.append(gdf_edges)
 
-        # add graph to folium map
-        m = ox.plot_graph_folium(ox.graph_from_gdfs(gdf_nodes, gdf_edges),
-                                 graph_map=m,
-                                 weight=3,
-                                 color=next_color,
-                                 popup_attribute="route_info",
-                                 opacity=1.0)
+    # add all tracks to folium map at once
+    if tracks_edges:
+        add_edges_geojson(m, pd.concat(tracks_edges), "route_info")
 
     # save folium html map
     map_save_highlight_edges(m, f"{outdir}/map.html")
@@ -298,44 +289,35 @@ def main():
     if args.debug:
         print("Plotting debug visualization with gps points included")
 
-        gdf_nodes, gdf_edges = ox.graph_to_gdfs(G_to_run)
-        gdf_edges['nodes'] = gdf_edges.apply(lambda x: f"[{x.name[0]}, {x.name[1]}]", axis=1)
-        m = ox.plot_graph_folium(ox.graph_from_gdfs(gdf_nodes, gdf_edges),
-                                tiles="CartoDB positron",
-                                fit_bounds=True,
-                                weight=3,
-                                color=TO_RUN_COLOR,
-                                popup_attribute="nodes",
-                                opacity=1.0)
+        gdf_edges = gdf_to_run.copy()
+        gdf_edges['nodes'] = [f"[{u}, {v}]" for (u,v,_) in gdf_edges.index]
+        m = folium.Map(tiles="CartoDB positron")
+        add_edges_geojson(m, gdf_edges, "nodes")
+        m.fit_bounds([(tb[1], tb[0]), (tb[3], tb[2])])
 
 
         colors = plt.rcParams['axes.prop_cycle'].by_key()['color']
+        tracks_edges = []
         for (i,t) in enumerate(tqdm(matched_tracks)):
             track,route = t
 
             # determine next color
             next_color = colors[i % len(colors)]
 
-            # get graph with only the runned edges
-            to_remove = set(e for e in G.edges(keys=True) if e not in route)
-            G_track = G.copy()
-            G_track.remove_edges_from(to_remove)
+            # get only the runned edges
+            route_list = list(set(route))
 
             # color edges in our color lookup
-            edges_ran = G_track.edges(keys=True)
-            edges_color.loc[edges_color.index.isin(edges_ran),"color"] = next_color
+            edges_color.loc[route_list,"color"] = next_color
 
             # add route info for interactive html popup
-            gdf_nodes, gdf_edges = ox.graph_to_gdfs(G_track)
-            gdf_edges['nodes'] = gdf_edges.apply(lambda x: f"[{x.name[0]}, {x.name[1]}]", axis=1)
+            gdf_edges = edges_color.loc[route_list].copy()
+            gdf_edges['nodes'] = [f"[{u}, {v}]" for (u,v,_) in gdf_edges.index]
+            tracks_edges.append(gdf_edges)
 
-            # add graph to folium map
-            m = ox.plot_graph_folium(ox.graph_from_gdfs(gdf_nodes, gdf_edges),
-                                    graph_map=m,
-                                    weight=3,
-                                    color=next_color,
-                                    popup_attribute="nodes",
-                                    opacity=1.0)
+        # add all tracks to folium map at once
+        if tracks_edges:
+            add_edges_geojson(m, pd.concat(tracks_edges), "nodes")
 
         # visualize gps points and matched points
         for (i,t) in enumerate(matched_tracks):
@@ -355,20 +337,15 @@ def main():
         print(f"Debug plotting done: {outdir}/map-debug.html")
 
 
-    print("Creating static plot")
-    # create and save static plot
-    fig,ax = plt.subplots(facecolor=BGCOLOR)
-    ax.set_facecolor(BGCOLOR)
-    ox.plot_graph(G,
-                  ax=ax,
-                  edge_linewidth=1,
-                  node_size=0,
-                  edge_color=edges_color["color"].tolist(),
-                  show=False
-                  )
-    save_plot(fig, "map", outdir)
-    save_plot(fig, "map", outdir, extension="png", dpi=800)
-    print("Static plot done")
+    if not args.no_static_plot:
+        print("Creating static plot")
+        # create and save static plot
+        fig,ax = plt.subplots(facecolor=BGCOLOR)
+        ax.set_facecolor(BGCOLOR)
+        plot_edges_static(ax, edges_color, edges_color["color"].tolist())
+        save_plot(fig, "map", outdir)
+        save_plot(fig, "map", outdir, extension="png", dpi=args.png_dpi)
+        print("Static plot done")
 
 
 
@@ -386,13 +363,12 @@ def main():
     #  - how much of total roads were "uncovered" (percentage) TODO
 
 
-    edges_total = G.edges(keys=True, data=True)
-    edges_runned = G_runned.edges(keys=True, data=True)
-    edges_to_run = G_to_run.edges(keys=True, data=True)
+    # edges_color already holds the lengths of all edges in G
+    lengths = edges_color["length"]
 
-    total_length_meters = sum([e[3]['length'] for e in edges_total])
-    runned_length_meters = sum([e[3]['length'] for e in edges_runned])
-    to_run_length_meters = sum([e[3]['length'] for e in edges_to_run])
+    total_length_meters = float(lengths.sum())
+    runned_length_meters = float(lengths.loc[list(runned_edges)].sum())
+    to_run_length_meters = float(lengths.loc[list(to_run_edges)].sum())
 
     runned_percentage = 100 * runned_length_meters / total_length_meters
     to_run_percentage = 100 * to_run_length_meters / total_length_meters
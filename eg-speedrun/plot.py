@@ -1,19 +1,20 @@
+import json
+from collections import defaultdict
+
+import folium
+import numpy as np
 import osmnx as ox
+from branca.element import MacroElement
+from jinja2 import Template
+from matplotlib.collections import LineCollection
 
 
 
-def map_save_highlight_edges(m, fname):
-    """Add highlight edge on hover to folium/leaflet map
-    and saves it to filename
-
-    :param m: folium map
-    :param fname: file path to save the file to
-    """
-    polyline_names = [k for k in m._children.keys() if k.startswith("poly_line")]
-    #polylines = [m._children[k] for k in m._children.keys() if k.startswith("poly_line")]
-
-    js = f'var polylines = [' + ','.join(polyline_names) + ']'
-    js += """
+class HighlightEdges(MacroElement):
+    """Highlight polylines of the parent map in red on hover"""
+    _template = Template("""
+        {% macro script(this, kwargs) %}
+var polylines = [{{ this.polyline_names }}]
 polylines.forEach(polyline => {
     polyline.on('mouseover', function(e) {
         var layer = e.target;
@@ -37,22 +38,100 @@ polylines.forEach(polyline => {
     });
 }
 )
-"""
+        {% endmacro %}
+    """)
+
+    def __init__(self, polyline_names):
+        super().__init__()
+        self._name = "HighlightEdges"
+        self.polyline_names = ",".join(polyline_names)
+
+
+
+def map_save_highlight_edges(m, fname):
+    """Add highlight edge on hover to folium/leaflet map
+    and saves it to filename
+
+    :param m: folium map
+    :param fname: file path to save the file to
+    """
+    polyline_names = [k for k in m._children.keys() if k.startswith("poly_line")]
+
+    # added last, so the script is rendered after the polylines it refers to
+    # (GeoJson layers highlight on their own and are not PolyLine children)
+    if polyline_names:
+        HighlightEdges(polyline_names).add_to(m)
     m.save(fname)
 
-    with open(fname) as f:
-        content = f.read()
 
-    content = content.replace("</script>", js + "</script>")
 
-    with open(fname, "w") as f:
-        f.write(content)
+class PolylineBlob(MacroElement):
+    """Polylines passed to leaflet as one coordinate array
+
+    Avoids creating a folium.PolyLine object per edge.
+    """
+    _template = Template("""
+        {% macro script(this, kwargs) %}
+        {{ this.coords }}.forEach(function(c) {
+            L.polyline(c, {{ this.options }}).addTo({{ this._parent.get_name() }});
+        });
+        {% endmacro %}
+    """)
+
+    def __init__(self, gdf_edges, **kwargs):
+        super().__init__()
+        self._name = "PolylineBlob"
+        # leaflet expects lat,lon but the geometries are lon,lat
+        self.coords = json.dumps([[(lat, lon) for (lon, lat) in geom.coords]
+                                  for geom in gdf_edges["geometry"]])
+        self.options = json.dumps(kwargs)
+
+
+
+def add_edges_polylines(m, gdf_edges, color, weight=3, opacity=1.0):
+    """Add edges to folium map as plain polylines without popups
+
+    :param m: folium map
+    :param gdf_edges: GeoDataFrame of edges
+    :param color: line color
+    :param weight: line width
+    :param opacity: line opacity
+    """
+    PolylineBlob(gdf_edges, color=color, weight=weight, opacity=opacity).add_to(m)
+
+
+
+def add_edges_geojson(m, gdf_edges, popup_attribute, weight=3, opacity=1.0):
+    """Add edges to folium map as a single GeoJson layer
+
+    Much faster than adding a PolyLine per edge for large numbers of edges.
+
+    :param m: folium map
+    :param gdf_edges: GeoDataFrame of edges with a "color" column
+    :param popup_attribute: column to show in the popup of an edge
+    :param weight: line width
+    :param opacity: line opacity
+    """
+    folium.GeoJson(gdf_edges[["geometry", "color", popup_attribute]],
+                   style_function=lambda f: {"color": f["properties"]["color"],
+                                             "weight": weight,
+                                             "opacity": opacity},
+                   highlight_function=lambda f: {"color": "red"},
+                   popup=folium.GeoJsonPopup(fields=[popup_attribute], labels=False)
+                   ).add_to(m)
 
 
 
 def plot_html_by_highway(G, fname):
     gdf_edges = ox.graph_to_gdfs(G, nodes=False)
-    hwytypes = list(set(gdf_edges["highway"].tolist()))
+
+    # collect the edges of each highway type in a single pass
+    edges_by_hwy = defaultdict(set)
+    for (edge,hwy) in zip(gdf_edges.index, gdf_edges["highway"]):
+        for h in (hwy if isinstance(hwy, list) else [hwy]):
+            edges_by_hwy[h].add(edge)
+    all_edges = set(gdf_edges.index)
+    hwytypes = list(edges_by_hwy)
 
     # define the colors to use for different edge types
     colorlist = [
@@ -73,17 +152,6 @@ def plot_html_by_highway(G, fname):
         ]
     hwy_colors = {hwytypes[i]:colorlist[i] for i in range(len(hwytypes))}
 
-    # return edge IDs that do not match passed list of hwys
-    def find_edges(G, hwys):
-        edges = []
-        for u, v, k, data in G.edges(keys=True, data='highway'):
-            check1 = isinstance(data, str) and data not in hwys
-            check2 = isinstance(data, list) and all([d not in hwys for d in data])
-            if check1 or check2:
-                edges.append((u, v, k))
-        return set(edges)
-
-
     # first plot all edges that do not appear in hwy_colors's types
     G_tmp = G.copy()
     m = ox.plot_graph_folium(G_tmp, weight=5, color='white')
@@ -91,7 +159,7 @@ def plot_html_by_highway(G, fname):
     # then plot each edge type in hwy_colors one at a time
     for hwy, color in hwy_colors.items():
         G_tmp = G.copy()
-        G_tmp.remove_edges_from(find_edges(G_tmp, [hwy]))
+        G_tmp.remove_edges_from(all_edges - edges_by_hwy[hwy])
         if G_tmp.edges:
             m = ox.plot_graph_folium(G_tmp,
                                     graph_map=m,
@@ -102,8 +170,7 @@ def plot_html_by_highway(G, fname):
 
 
 
-def plot_html_debug(G, fname, graphml_cache):
-    G = ox.load_graphml(filepath=graphml_cache)
+def plot_html_debug(G, fname):
     G = ox.utils_graph.get_undirected(G)
     gdf_nodes, gdf_edges = ox.graph_to_gdfs(G)
     gdf_edges['summary'] = gdf_edges.apply(lambda x:
@@ -116,3 +183,37 @@ def plot_html_debug(G, fname, graphml_cache):
                             weight=3,
                             popup_attribute="summary")
     map_save_highlight_edges(m, fname)
+
+
+
+def plot_edges_static(ax, gdf_edges, colors, linewidth=1, padding=0.02):
+    """Plot edges on matplotlib axis as a single LineCollection
+
+    Looks like ox.plot_graph with node_size=0, but reuses the edges
+    GeoDataFrame instead of converting the graph again.
+
+    :param ax: matplotlib axis
+    :param gdf_edges: GeoDataFrame of edges in lat/lon
+    :param colors: list of colors, one per edge
+    :param linewidth: line width
+    :param padding: relative padding around the edges' bounds
+    """
+    segments = [np.asarray(geom.coords) for geom in gdf_edges["geometry"]]
+    ax.add_collection(LineCollection(segments, colors=colors, linewidths=linewidth, zorder=1))
+
+    west, south, east, north = gdf_edges.total_bounds
+    padding_ns = (north - south) * padding
+    padding_ew = (east - west) * padding
+    ax.set_ylim((south - padding_ns, north + padding_ns))
+    ax.set_xlim((west - padding_ew, east + padding_ew))
+
+    # no border, ticks or axes around the plot
+    ax.margins(0)
+    ax.tick_params(which="both", direction="in")
+    for spine in ax.spines.values():
+        spine.set_visible(False)
+    ax.get_xaxis().set_visible(False)
+    ax.get_yaxis().set_visible(False)
+
+    # lat/lon is not projected, conform aspect ratio to not stretch plot
+    ax.set_aspect(1 / np.cos((south + north) / 2 / 180 * np.pi))